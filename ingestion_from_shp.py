@@ -11,13 +11,19 @@ Ingestion SHP -> Supabase (PostGIS), 1 table par couche d'un dossier.
 import os
 import re
 import sys
+import struct
 import json
 import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import Optional, Tuple, Iterable
+from typing import Optional, Iterable, Iterator, Sequence
 
+import pandas as pd
+import pyarrow as pa
 import geopandas as gpd
 gpd.options.io_engine = "pyogrio"  # lecture robuste (encodages/CPG)
+from pyogrio import read_info
+from pyogrio.raw import open_arrow
 
 from sqlalchemy import text
 from sqlalchemy.engine import Engine
@@ -26,6 +32,8 @@ from sqlalchemy.engine.url import URL
 from geoalchemy2 import Geometry
 from dotenv import load_dotenv
 
+from utils_load import copy_to_postgis, execute_script, detect_encoding
+
 # ------------- CONFIG -------------
 # Dossier par défaut (modifiable ou passé en argv[1])
 RACINE_DONNEES = "/Users/benjaminbenoit/Downloads/cote_de_seuil_ppri"
@@ -35,21 +43,29 @@ PG_SCHEMA = "public"
 # Comportement si la table existe déjà: "replace" (écrase) ou "append"
 IF_EXISTS = "replace"
 
-# Chunk d'insertion (utile pour grosses couches)
-CHUNKSIZE = 5000
+# Lecture/insertion en flux par lots d'entités (mémoire bornée à un lot)
+BATCH_SIZE = 50000
 
 # Vues & policies (mêmes options qu’avant)
 CREATE_GEOJSON_VIEW = False
 CREATE_REPROJECTED_VIEW_4326 = False
 APPLY_RLS_AND_GRANT = True
 
+# Fichiers ingérés en parallèle (1 processus = 1 connexion Supabase : rester
+# sous max_connections du pooler)
+MAX_WORKERS = os.cpu_count() or 1
+
 PG_NAME_MAXLEN = 63
 # ----------------------------------
 
+# regex de slugify, compilées une fois à l'import
+_SLUG_NONALNUM = re.compile(r"[^a-z0-9_]+")
+_SLUG_DEDUPE = re.compile(r"_+")
+
 logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
 
 
-def mk_engine_from_env() -> Engine:
+def mk_engine_from_env(**engine_kw) -> Engine:
     load_dotenv()
     host = os.getenv("SUPABASE_HOST")
     port = int(os.getenv("SUPABASE_PORT", "6543"))  # pooler recommandé
@@ -69,7 +85,10 @@ def mk_engine_from_env() -> Engine:
         database=db,
         query={"sslmode": "require"},
     )
-    return create_engine(url, pool_pre_ping=True)
+    # pooler en mode transaction (6543) : les requêtes préparées ne survivent pas
+    # d'une transaction à l'autre -> désactivées ; 5432 garde l'auto-prepare par défaut
+    connect_args = {"prepare_threshold": None} if port == 6543 else {}
+    return create_engine(url, pool_pre_ping=True, connect_args=connect_args, **engine_kw)
 
 
 def ensure_postgis_and_helpers(engine: Engine):
@@ -94,7 +113,7 @@ def ensure_postgis_and_helpers(engine: Engine):
           FROM information_schema.columns
           WHERE table_schema = p_schema
             AND table_name   = p_table
-            AND column_name <> 'geom';
+            AND column_name NOT IN ('geom', 'geom_4326');
           IF cols IS NULL THEN
             RAISE EXCEPTION 'Table %.% introuvable ou sans colonnes', p_schema, p_table;
           END IF;
@@ -117,9 +136,8 @@ def list_shp_files(root: str) -> Iterable[str]:
 
 
 def slugify(name: str) -> str:
-    name = name.lower()
-    name = re.sub(r"[^a-z0-9_]+", "_", name)
-    name = re.sub(r"_+", "_", name).strip("_")
+    name = _SLUG_NONALNUM.sub("_", name.lower())
+    name = _SLUG_DEDUPE.sub("_", name).strip("_")
     return name[:PG_NAME_MAXLEN]
 
 
@@ -151,114 +169,185 @@ def detect_srid(gdf: gpd.GeoDataFrame) -> Optional[int]:
         return None
 
 
-def has_z_any(gdf: gpd.GeoDataFrame) -> bool:
-    for geom in gdf.geometry:
-        if geom is None: continue
-        try:
-            if getattr(geom, "has_z", False): return True
-        except Exception:
-            pass
-    return False
-
-
-def geom_type_for_column(gdf: gpd.GeoDataFrame, z: bool) -> Tuple[str, bool]:
-    types = set([t.upper() for t in gdf.geom_type.dropna().unique()])
-    norm = []
-    for t in types:
-        if t.endswith("ZM") or t.endswith("Z"):
-            t = t.replace("ZM","").replace("Z","")
-        norm.append(t)
-    types = set(norm)
-    if len(types) == 0:
-        return ("GEOMETRYZ" if z else "GEOMETRY", True)
-    if len(types) == 1:
-        t = list(types)[0]
-        return (f"{t}Z" if z else t, False)
-    return ("GEOMETRYZ" if z else "GEOMETRY", True)
-
-
-def read_shp_robust(path: str) -> gpd.GeoDataFrame:
+# Shape Types .shp avec Z : PointZ, PolyLineZ, PolygonZ, MultiPointZ, MultiPatch
+# (les types M 21/23/25/28 n'ont pas de Z : la mesure est ignorée à la lecture)
+SHP_Z_TYPES = (11, 13, 15, 18, 31)
+
+
+def shp_has_z(path: str) -> bool:
+    """Z lu dans l'en-tête .shp (Shape Type : int32 little-endian à l'octet 32), sans lire les géométries."""
+    with open(path, "rb") as f:
+        f.seek(32)
+        (shape_type,) = struct.unpack("<i", f.read(4))
+    return shape_type in SHP_Z_TYPES
+
+
+# types Arrow -> pandas stables d'un lot à l'autre (sinon un entier avec nulls
+# deviendrait float64 dans un lot et int64 dans le suivant)
+_ARROW_TO_PANDAS = {
+    pa.int8(): pd.Int8Dtype(),
+    pa.int16(): pd.Int16Dtype(),
+    pa.int32(): pd.Int32Dtype(),
+    pa.int64(): pd.Int64Dtype(),
+    pa.bool_(): pd.BooleanDtype(),
+}
+
+
+def _strings_decode(path: str, enc: Optional[str], columns: Optional[Sequence[str]]) -> bool:
+    """
+    Passe DBF seule (sans géométries, colonnes texte seulement) sur tout le fichier :
+    les chaînes lues avec `enc` sont-elles de l'UTF-8 valide ? GDAL ne lève rien sur
+    un encodage faux, il rend de l'UTF-8 invalide qui ne casserait qu'au COPY.
     """
-    Lecture robuste d'un SHP avec encodage tolérant.
-    Essaie .cpg s'il existe, sinon utf-8 → latin-1 → cp1252.
+    info = read_info(path, encoding=enc)
+    fields = [f for f, dt in zip(info["fields"], info["dtypes"])
+              if dt == "object" and (columns is None or f in columns)]
+    if not fields:
+        return True
+    with open_arrow(path, encoding=enc, columns=fields, read_geometry=False,
+                    use_pyarrow=True) as (_, reader):
+        for batch in reader:
+            for col in batch.columns:
+                if pa.types.is_string(col.type) or pa.types.is_large_string(col.type):
+                    try:
+                        col.validate(full=True)
+                    except pa.ArrowInvalid:
+                        return False
+    return True
+
+
+def _arrow_batches(path: str, enc: Optional[str], columns: Optional[Sequence[str]],
+                   batch_size: int) -> Iterator[gpd.GeoDataFrame]:
+    with open_arrow(path, encoding=enc, columns=columns, batch_size=batch_size,
+                    use_pyarrow=True) as (meta, reader):
+        geom_name = meta["geometry_name"] or "wkb_geometry"
+        for batch in reader:
+            df = batch.to_pandas(types_mapper=_ARROW_TO_PANDAS.get, date_as_object=False)
+            geom = gpd.GeoSeries.from_wkb(df.pop(geom_name).values, crs=meta["crs"])
+            yield gpd.GeoDataFrame(df, geometry=geom)
+
+
+def iter_shp_batches(path: str, columns: Optional[Sequence[str]] = None,
+                     batch_size: int = BATCH_SIZE) -> Iterator[gpd.GeoDataFrame]:
     """
-    cpg = Path(path).with_suffix(".cpg")
-    enc_hint = None
-    if cpg.exists():
-        raw = cpg.read_text(errors="ignore").strip().upper()
-        enc_map = {
-            "UTF-8": "utf-8",
-            "UTF8": "utf-8",
-            "LATIN1": "latin-1",
-            "ISO-8859-1": "latin-1",
-            "CP1252": "cp1252",
-            "WINDOWS-1252": "cp1252",
-        }
-        enc_hint = enc_map.get(raw, raw.lower())
-
-    trials = [enc_hint, "utf-8", "latin-1", "cp1252"]
-    for enc in filter(None, trials):
+    Lecture en flux d'un SHP (pyogrio/Arrow), par lots de `batch_size` entités :
+    la mémoire reste bornée à un lot et l'insertion démarre dès le premier.
+    Encodage : .cpg s'il existe, sinon UTF-8 → ISO-8859-1 → CP1252, puis GDAL ;
+    chaque essai est validé sur tout le fichier (passe DBF seule) avant le premier lot,
+    donc avant que la table ne soit touchée.
+    `columns` restreint les attributs lus (None = tous).
+    """
+    enc_hint = detect_encoding(str(Path(path).with_suffix(".cpg")))
+    # None en dernier recours : laisse pyogrio/GDAL décider
+    trials = [*filter(None, [enc_hint, "UTF-8", "ISO-8859-1", "CP1252"]), None]
+    for enc in trials:
         try:
-            return gpd.read_file(path, encoding=enc)
+            if _strings_decode(path, enc, columns):
+                break
         except Exception:
-            continue
-
-    # dernier recours : laisse gpd décider
-    return gpd.read_file(path)
+            if enc is None:
+                raise
+    else:
+        raise ValueError(f"{path}: attributs texte illisibles (encodages testés : {trials[:-1]})")
+    yield from _arrow_batches(path, enc, columns, batch_size)
 
 
-def to_postgis(engine: Engine, gdf: gpd.GeoDataFrame, table: str, schema: str, srid: Optional[int], z: bool):
-    gtype, mixed = geom_type_for_column(gdf, z)
-    geom_dtype = Geometry(geometry_type=gtype, srid=srid, dimension=3 if z else 2)
-    logging.info(f"-> table={schema}.{table}  geom={gtype}  srid={srid}  mixed={mixed}")
+def to_postgis(engine: Engine, gdf: gpd.GeoDataFrame, table: str, schema: str, srid: Optional[int], z: bool,
+               batches: Iterable[gpd.GeoDataFrame] = ()):
+    # colonne générique (GEOMETRYZ si Z : la dimension seule ne change pas le DDL) ;
+    # typmod précis + index spatial posés après chargement
+    geom_dtype = Geometry(geometry_type="GEOMETRYZ" if z else "GEOMETRY", srid=srid,
+                          dimension=3 if z else 2, spatial_index=False)
+    logging.info(f"-> table={schema}.{table}  srid={srid}  z={z}")
 
     with engine.begin() as conn:
         conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {schema}"))
 
-    gdf.to_postgis(
-        name=table,
-        con=engine,
+    copy_to_postgis(
+        engine,
+        gdf,
+        table,
         schema=schema,
         if_exists=IF_EXISTS,
-        index=False,
         dtype={"geom": geom_dtype} if "geom" in gdf.columns else {"geometry": geom_dtype},
-        chunksize=CHUNKSIZE
+        batches=batches,
+        srid=srid,
+        output_dimension=3 if z else 2,
     )
 
-    with engine.begin() as conn:
-        # uniformiser le nom de la colonne
-        cols = conn.execute(text("""
-            SELECT column_name FROM information_schema.columns
-            WHERE table_schema=:s AND table_name=:t
-        """), {"s": schema, "t": table}).fetchall()
-        colnames = {c[0] for c in cols}
-        if "geometry" in colnames and "geom" not in colnames:
-            conn.execute(text(f'ALTER TABLE "{schema}"."{table}" RENAME COLUMN "geometry" TO "geom"'))
-        # index spatial + stats
-        conn.execute(text(f'CREATE INDEX IF NOT EXISTS "{table}_geom_gix" ON "{schema}"."{table}" USING GIST("geom")'))
-        # clef primaire (utile QGIS)
-        conn.execute(text(f'ALTER TABLE "{schema}"."{table}" ADD COLUMN IF NOT EXISTS id bigserial'))
-        try:
-            conn.execute(text(f'ALTER TABLE "{schema}"."{table}" ADD CONSTRAINT "{table}_pkey" PRIMARY KEY (id)'))
-        except Exception:
-            pass
-        conn.execute(text(f'ANALYZE "{schema}"."{table}"'))
-
-
-def create_views_and_policies(engine: Engine, schema: str, table: str):
+    # post-traitements en une seule transaction / un seul aller-retour
+    execute_script(engine, post_load_statements(schema, table, srid, z))
+
+
+def post_load_statements(schema: str, table: str, srid: Optional[int], z: bool) -> list:
+    """DDL après chargement : nom de colonne, typmod, index spatial, PK, stats (sans paramètres)."""
+    tbl = f'"{schema}"."{table}"'
+    zs = "Z" if z else ""
+    using = 'ST_Force3D("geom")' if z else '"geom"'
+    return [
+        # uniformiser le nom de la colonne (idempotent)
+        f"""DO $$ BEGIN
+          IF EXISTS (SELECT 1 FROM information_schema.columns
+                     WHERE table_schema='{schema}' AND table_name='{table}' AND column_name='geometry')
+             AND NOT EXISTS (SELECT 1 FROM information_schema.columns
+                     WHERE table_schema='{schema}' AND table_name='{table}' AND column_name='geom') THEN
+            ALTER TABLE {tbl} RENAME COLUMN "geometry" TO "geom";
+          END IF;
+        END $$""",
+        # typmod exact si la couche est homogène (classification en un seul scan PostGIS) ;
+        # seulement tant que la colonne est générique : en append elle est déjà typée
+        # (et un ALTER TYPE échouerait sous une vue ou la colonne générée geom_4326)
+        f"""DO $$ DECLARE gtypes text[];
+        BEGIN
+          IF (SELECT postgis_typmod_type(atttypmod) FROM pg_attribute
+              WHERE attrelid = '{tbl}'::regclass AND attname = 'geom') IN ('Geometry', 'GeometryZ') THEN
+            SELECT array_agg(DISTINCT GeometryType("geom")) INTO gtypes FROM {tbl} WHERE "geom" IS NOT NULL;
+            IF array_length(gtypes, 1) = 1 THEN
+              EXECUTE 'ALTER TABLE {tbl} ALTER COLUMN "geom" TYPE geometry('
+                      || gtypes[1] || '{zs},{srid or 0}) USING {using}';
+            END IF;
+          END IF;
+        END $$""",
+        # index spatial
+        f'CREATE INDEX IF NOT EXISTS "{table}_geom_gix" ON {tbl} USING GIST("geom")',
+        # clef primaire (utile QGIS) ; ignorée si déjà présente
+        f'ALTER TABLE {tbl} ADD COLUMN IF NOT EXISTS id bigserial',
+        f"""DO $$ BEGIN
+          ALTER TABLE {tbl} ADD CONSTRAINT "{table}_pkey" PRIMARY KEY (id);
+        EXCEPTION WHEN invalid_table_definition OR duplicate_table OR duplicate_object THEN NULL;
+        END $$""",
+        # stats
+        f'ANALYZE {tbl}',
+    ]
+
+
+def create_views_and_policies(engine: Engine, schema: str, table: str,
+                              srid: Optional[int] = None, z: bool = False):
     view_geojson = f"v_{table}"
     with engine.begin() as conn:
         # Vue GeoJSON
         if CREATE_GEOJSON_VIEW:
             conn.execute(text("SELECT public.create_geojson_view(:s,:t,:v)"),
                          {"s": schema, "t": table, "v": view_geojson})
-        # Vue 4326
-        if CREATE_REPROJECTED_VIEW_4326:
+        # 4326 : colonne générée (reprojection PostGIS une fois à l'écriture) + index,
+        # la vue reste un simple alias pour compatibilité
+        if CREATE_REPROJECTED_VIEW_4326 and srid is None:
+            logging.warning(f"  -> {table}: SRID inconnu, pas de colonne 4326.")
+        elif CREATE_REPROJECTED_VIEW_4326:
             view_reproj = f"v_{table}_4326"
+            gtype = "GeometryZ" if z else "Geometry"
+            conn.execute(text(f"""
+                ALTER TABLE "{schema}"."{table}"
+                ADD COLUMN IF NOT EXISTS geom_4326 geometry({gtype},4326)
+                GENERATED ALWAYS AS (ST_Transform(geom, 4326)) STORED
+            """))
+            conn.execute(text(
+                f'CREATE INDEX IF NOT EXISTS "{table}_geom_4326_gix" '
+                f'ON "{schema}"."{table}" USING GIST("geom_4326")'
+            ))
             conn.execute(text(f"""
                 CREATE OR REPLACE VIEW "{schema}"."{view_reproj}" AS
-                SELECT *, ST_Transform(geom, 4326) AS geom_4326
-                FROM "{schema}"."{table}";
+                SELECT * FROM "{schema}"."{table}";
             """))
 
         if APPLY_RLS_AND_GRANT:
@@ -283,6 +372,54 @@ def create_views_and_policies(engine: Engine, schema: str, table: str):
                 conn.execute(text(f'GRANT SELECT ON "{schema}"."{view_geojson}" TO anon'))
 
 
+# engine propre à chaque worker (un Engine ne survit pas au fork)
+_ENGINE: Optional[Engine] = None
+
+
+def _init_worker():
+    global _ENGINE
+    _ENGINE = mk_engine_from_env(pool_size=1, max_overflow=0)
+
+
+def _prepare_batch(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    gdf = sanitize_columns(gdf)
+    if "geometry" in gdf.columns:
+        gdf = gdf.rename(columns={"geometry": "geom"})
+
+    # ⚡️ rétablir la géométrie active sur 'geom'
+    if "geom" in gdf.columns:
+        gdf = gdf.set_geometry("geom")
+    return gdf
+
+
+def _ingest_one(shp: str, root: str) -> dict:
+    """Ingère un SHP dans le worker courant. Retourne {"file", "table"} ou {"file", "error"}."""
+    try:
+        logging.info(f"=== {shp}")
+        z = shp_has_z(shp)
+        batches = iter_shp_batches(shp)
+        gdf = next(batches, None)
+        if gdf is None or gdf.empty:
+            logging.warning(f"  -> {shp} vide, on saute.")
+            return {"file": shp, "table": None}
+
+        srid = detect_srid(gdf)
+        if srid is None:
+            logging.warning(f"  -> {shp}: CRS inconnu (.prj manquant ?), stockage sans SRID explicite.")
+
+        gdf = _prepare_batch(gdf)
+        table = table_name_from_path(root, shp)
+
+        to_postgis(_ENGINE, gdf, table, PG_SCHEMA, srid, z,
+                   batches=(_prepare_batch(b) for b in batches))
+        create_views_and_policies(_ENGINE, PG_SCHEMA, table, srid, z)
+        return {"file": shp, "table": table}
+
+    except Exception as e:
+        logging.exception(f"ERREUR {shp}: {e}")
+        return {"file": shp, "error": str(e)}
+
+
 def main():
     root = sys.argv[1] if len(sys.argv) > 1 else RACINE_DONNEES
     root = os.path.abspath(root)
@@ -290,37 +427,19 @@ def main():
 
     engine = mk_engine_from_env()
     ensure_postgis_and_helpers(engine)
+    engine.dispose()  # aucune connexion héritée par les workers
 
     errors = []
-    for shp in list_shp_files(root):
-        try:
-            logging.info(f"=== {shp}")
-            gdf = read_shp_robust(shp)
-            if gdf.empty:
-                logging.warning("  -> vide, on saute.")
-                continue
-
-            srid = detect_srid(gdf)
-            if srid is None:
-                logging.warning("  -> CRS inconnu (.prj manquant ?), stockage sans SRID explicite.")
-
-            gdf = sanitize_columns(gdf)
-            if "geometry" in gdf.columns:
-                gdf = gdf.rename(columns={"geometry": "geom"})
-
-            # ⚡️ rétablir la géométrie active sur 'geom'
-            if "geom" in gdf.columns:
-                gdf = gdf.set_geometry("geom")
-
-            z = has_z_any(gdf)
-            table = table_name_from_path(root, shp)
-
-            to_postgis(engine, gdf, table, PG_SCHEMA, srid, z)
-            create_views_and_policies(engine, PG_SCHEMA, table)
-
-        except Exception as e:
-            logging.exception(f"ERREUR {shp}: {e}")
-            errors.append({"file": shp, "error": str(e)})
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=_init_worker) as pool:
+        futures = {pool.submit(_ingest_one, shp, root): shp for shp in list_shp_files(root)}
+        for fut in as_completed(futures):
+            try:
+                res = fut.result()
+            except Exception as e:  # worker tué (BrokenProcessPool, OOM...)
+                logging.exception(f"ERREUR {futures[fut]}: {e}")
+                res = {"file": futures[fut], "error": str(e)}
+            if "error" in res:
+                errors.append(res)
 
     if errors:
         out = Path("ingest_shp_errors.json")
@@ -9,8 +9,22 @@ from utils_db import (
 
 st.set_page_config(page_title="PostGIS Browser + Uploader", layout="wide")
 
-# Connexion
-engine = get_engine()  # lit .env (SUPABASE_HOST, USER, PASSWORD, DB, PORT)
+# Connexion (un seul Engine par process Streamlit, pas un par rerun)
+@st.cache_resource(show_spinner=False)
+def cached_engine():
+    return get_engine()  # lit .env (SUPABASE_HOST, USER, PASSWORD, DB, PORT)
+
+engine = cached_engine()
+DB_KEY = engine.url.render_as_string(hide_password=True)  # clé de cache (sans mot de passe)
+
+# Métadonnées mises en cache : évite un aller-retour Supabase à chaque rerun
+@st.cache_data(ttl=60, show_spinner=False)
+def cached_tables(db_key):
+    return list_postgis_tables(cached_engine())
+
+@st.cache_data(ttl=60, show_spinner=False)
+def cached_overview(db_key, schema, table, geom_col):
+    return table_overview(cached_engine(), schema, table, geom_col)
 
 st.title("PostGIS (Supabase) — Browser & Shapefile Uploader")
 
@@ -32,19 +46,20 @@ if st.checkbox("🔧 Debug connexion"):
         st.exception(e)
 
 # === Tables géométriques ===
-tables = list_postgis_tables(engine)  # [{schema, table, geom_column, geom_type, srid}]
+tables = cached_tables(DB_KEY)  # [{schema, table, geom_column, geom_type, srid}]
 
 if not tables:
     st.warning("Aucune table PostGIS détectée.")
 else:
     # Créer un dictionnaire pour la recherche rapide
-    table_dict = {t['table']: t for t in tables}
+    # (une entrée par colonne géométrique : geom et geom_4326 d'une même table)
+    table_dict = {(t['schema'], t['table'], t['geom_column']): t for t in tables}
     table_names = list(table_dict.keys())
     
     # Menu déroulant avec recherche en temps réel
-    def format_table_option(name):
-        table_info = table_dict[name]
-        return f"{name} ({table_info['geom_column']} :: {table_info['geom_type']}, SRID={table_info['srid']})"
+    def format_table_option(key):
+        table_info = table_dict[key]
+        return f"{table_info['table']} ({table_info['geom_column']} :: {table_info['geom_type']}, SRID={table_info['srid']})"
     
     # Utiliser un selectbox avec recherche intégrée
     selected_table = st.selectbox(
@@ -59,14 +74,14 @@ else:
     if selected_table:
         tsel = table_dict[selected_table]
         with st.spinner("Chargement aperçu…"):
-            meta = table_overview(engine, tsel["schema"], tsel["table"], tsel["geom_column"])
+            meta = cached_overview(DB_KEY, tsel["schema"], tsel["table"], tsel["geom_column"])
 
         c1, c2 = st.columns(2)
-        c1.metric("Lignes", f"{meta['row_count']:,}")
+        c1.metric("Lignes (≈)" if meta["row_count_estimated"] else "Lignes", f"{meta['row_count']:,}")
         c2.write("**Colonnes**")
         c2.dataframe(pd.DataFrame(meta["columns"], columns=["column", "type"]), use_container_width=True)
 
-        st.write("**Aperçu (WKT tronqué)**")
+        st.write("**Aperçu (emprise WKT)**")
         st.dataframe(meta["preview"], use_container_width=True)
 
 st.divider()
@@ -84,6 +99,9 @@ if st.button("Importer"):
         with st.spinner("Import en cours…"):
             info = upload_shapefile_zip(engine, up, schema=default_schema or "public",
                                         table_name=default_name or None)
+        # la nouvelle table doit apparaître au prochain rerun
+        cached_tables.clear()
+        cached_overview.clear()
         st.success(
             f"Import réussi : {info['schema']}.{info['table']} "
             f"({info['geom_type']}, SRID={info['srid']}) — {info['rows']} lignes."
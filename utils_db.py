@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 import os, io, zipfile, tempfile, re
 import pandas as pd
+import pyarrow as pa
 import geopandas as gpd
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine.url import URL
 from shapely.geometry import GeometryCollection
 from geoalchemy2 import Geometry
 
+from utils_load import copy_to_postgis, is_psycopg3_backend, read_cpg
+
 # Helper pour Streamlit Cloud (secrets) + .env local
 try:
     import streamlit as st
@@ -29,6 +32,9 @@ try:
 except Exception:
     pass
 
+# nom de table dérivé du .shp (compilée une fois à l'import)
+_TABLE_NONALNUM = re.compile(r"[^A-Za-z0-9_]+")
+
 def _env(k, d=None): 
     v = os.getenv(k, d)
     return v.strip() if isinstance(v, str) else v
@@ -58,11 +64,11 @@ def get_engine():
         query={"sslmode": "require", "connect_timeout": "10"},
     )
 
-    # Si tu passes en transaction mode (6543), tu peux ajouter :
-    # connect_args={"prepare_threshold": 0}
-    # return create_engine(url, pool_pre_ping=True, connect_args={"prepare_threshold": 0})
+    # Transaction mode (6543) : les requêtes préparées ne survivent pas d'une transaction
+    # à l'autre (DuplicatePreparedStatement) -> désactivées ; 5432 garde l'auto-prepare
+    connect_args = {"prepare_threshold": None} if port == 6543 else {}
 
-    return create_engine(url, pool_pre_ping=True)
+    return create_engine(url, pool_pre_ping=True, connect_args=connect_args)
 
 
 def list_postgis_tables(engine):
@@ -81,34 +87,75 @@ def list_postgis_tables(engine):
       AND NOT a.attisdropped
       AND c.relkind IN ('r','p','m','f','v')
       AND n.nspname NOT IN ('pg_catalog','information_schema','pg_toast','extensions')
-    ORDER BY n.nspname, c.relname;
+    ORDER BY n.nspname, c.relname, a.attnum;
     """
     return pd.read_sql(sql, engine).to_dict(orient="records")
 
+def _arrow_column(values):
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):  # types hétérogènes -> texte
+        return pa.array([None if v is None else str(v) for v in values])
+
+def _fetch_arrow(engine, sql):
+    """Requête -> pyarrow.Table via un curseur psycopg3 binaire (ni SQLAlchemy ni pandas)."""
+    rc = engine.raw_connection()
+    try:
+        with rc.driver_connection.cursor(binary=True) as cur:
+            cur.execute(sql)
+            names = [d.name for d in cur.description]
+            rows = cur.fetchall()
+    finally:
+        rc.close()
+    columns = list(zip(*rows)) or [()] * len(names)
+    return pa.Table.from_arrays([_arrow_column(c) for c in columns], names=names)
+
+def _qi(name):
+    """Identifiant SQL entre guillemets ('"' interne doublé) : tables hors de cet outil."""
+    return '"' + str(name).replace('"', '""') + '"'
+
+# en dessous, COUNT(*) exact (rapide) plutôt que l'estimation reltuples
+EXACT_COUNT_BELOW = 10000
+
 def table_overview(engine, schema, table, geom_col):
     # Colonnes
     cols = pd.read_sql(
-        text("""SELECT column_name, data_type
+        text("""SELECT column_name, data_type, udt_name
                 FROM information_schema.columns
                 WHERE table_schema=:s AND table_name=:t
                 ORDER BY ordinal_position"""),
         engine, params={"s": schema, "t": table}
     )
-    # Nombre de lignes (robuste si l'objet n'est pas directement requêtable)
-    try:
-        n = pd.read_sql(
-            text(f'SELECT COUNT(*) AS n FROM "{schema}"."{table}"'), engine
-        )["n"].iloc[0]
-    except Exception:
-        n = 0
+    # Nombre de lignes : estimation du planificateur (pg_class.reltuples, aucun scan) ;
+    # COUNT(*) exact seulement pour les petites tables / stats absentes (vues, jamais ANALYZE)
+    est = pd.read_sql(
+        text("""SELECT c.reltuples::bigint AS n
+                FROM pg_class c JOIN pg_namespace ns ON ns.oid = c.relnamespace
+                WHERE ns.nspname=:s AND c.relname=:t"""),
+        engine, params={"s": schema, "t": table}
+    )["n"]
+    n = int(est.iloc[0]) if len(est) else -1
+    estimated = n >= EXACT_COUNT_BELOW
+    if not estimated:
+        # robuste si l'objet n'est pas directement requêtable
+        try:
+            n = pd.read_sql(
+                text(f'SELECT COUNT(*) AS n FROM {_qi(schema)}.{_qi(table)}'), engine
+            )["n"].iloc[0]
+        except Exception:
+            n = 0
 
-    # Aperçu (WKT tronqué)
+    # Aperçu : attributs + emprise WKT (taille constante, quel que soit le nombre de sommets)
+    select = [_qi(c) for c, udt in zip(cols["column_name"], cols["udt_name"])
+              if c != geom_col and udt != "geometry"]
+    select.append(f'ST_AsText(ST_Envelope({_qi(geom_col)})) AS wkt_bbox')
     q = f'''
-    SELECT *, LEFT(ST_AsText("{geom_col}"), 120) AS wkt
-    FROM "{schema}"."{table}" LIMIT 200
+    SELECT {", ".join(select)}
+    FROM {_qi(schema)}.{_qi(table)} LIMIT 200
     '''
-    preview = pd.read_sql(q, engine)
-    return {"columns": cols.values.tolist(), "row_count": int(n), "preview": preview}
+    preview = _fetch_arrow(engine, q) if is_psycopg3_backend(engine) else pd.read_sql(q, engine)
+    return {"columns": cols[["column_name", "data_type"]].values.tolist(), "row_count": int(n),
+            "row_count_estimated": estimated, "preview": preview}
 
 def _geom_family(gdf):
     fams = set(gdf.geom_type.dropna().str.upper())
@@ -117,7 +164,6 @@ def _geom_family(gdf):
     if fams & {"POINT","MULTIPOINT"}: return "MULTIPOINT"
     return "GEOMETRY"
 
-# --- helper robuste d'ouverture avec encodage ---
 def _read_gdf_try_encodings(path, enc_hint=None):
     import geopandas as gpd
     trials = []
@@ -139,7 +185,7 @@ def _read_gdf_try_encodings(path, enc_hint=None):
 
 def upload_shapefile_zip(engine, uploaded_file, schema="public", table_name=None, default_epsg=None):
     import logging
-    import os, zipfile, tempfile, re
+    import os, zipfile, tempfile
     from pathlib import Path
     import geopandas as gpd
 
@@ -163,19 +209,10 @@ def upload_shapefile_zip(engine, uploaded_file, schema="public", table_name=None
 
         if not table_name:
             base = shp.stem
-            table_name = re.sub(r"[^A-Za-z0-9_]+", "_", base.lower())
+            table_name = _TABLE_NONALNUM.sub("_", base.lower())
 
         # ✅ encodage via .cpg si présent
-        cpg = shp.with_suffix(".cpg")
-        enc_hint = None
-        if cpg.exists():
-            raw = cpg.read_text(errors="ignore").strip().upper()
-            map_enc = {
-                "UTF-8": "utf-8", "UTF8": "utf-8",
-                "LATIN1": "latin-1", "ISO-8859-1": "latin-1",
-                "CP1252": "cp1252", "WINDOWS-1252": "cp1252",
-            }
-            enc_hint = map_enc.get(raw, raw.lower())
+        enc_hint = read_cpg(str(shp.with_suffix(".cpg")))
 
         # 🔎 lecture tolérante (UTF-8 → Latin-1 → CP1252)
         gdf = _read_gdf_try_encodings(shp, enc_hint=enc_hint)
@@ -193,8 +230,10 @@ def upload_shapefile_zip(engine, uploaded_file, schema="public", table_name=None
 
         # --- écriture: typé + SRID quand on peut (meilleure perf/metadata)
         fam = _geom_family(gdf)
-        dtype = {"geom": Geometry(geometry_type=fam if srid else "GEOMETRY", srid=srid)}
-        gdf.to_postgis(table_name, engine, schema=schema, if_exists="replace", index=False, dtype=dtype)
+        # index spatial créé après chargement (pas pendant le COPY)
+        dtype = {"geom": Geometry(geometry_type=fam if srid else "GEOMETRY", srid=srid, spatial_index=False)}
+        copy_to_postgis(engine, gdf, table_name, schema=schema, if_exists="replace", dtype=dtype,
+                        srid=srid)
 
         # --- post-traitements: PK + index spatial + stats
         with engine.begin() as conn:
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# Chargement PostGIS (COPY binaire, scripts DDL) et lecture des .cpg.
+# Sans Streamlit ni secrets : importé par la CLI d'ingestion et par utils_db.
+import os, functools
+from itertools import chain
+import numpy as np
+import pandas as pd
+import shapely
+from sqlalchemy import text
+
+# --- écriture rapide : COPY binaire (psycopg3) ---
+BYTEA_OID = 17  # octets bruts -> le serveur les passe tels quels à geometry_recv (WKB/EWKB)
+COPY_TILE = 20000  # lignes encodées par tuile (au-delà de ~10k le gain plafonne)
+COPY_WRITE_BYTES = 4 << 20  # taille visée d'un cp.write du chemin numpy
+
+def is_psycopg3_backend(engine):
+    return engine.dialect.driver == "psycopg"
+
+def _copy_values(values):
+    """Tranche de colonne -> objets Python pour write_row (NaN/NaT/NA -> NULL)."""
+    out = np.asarray(values.astype(object), dtype=object)
+    out[pd.isna(out)] = None
+    return out
+
+# --- chemin rapide : colonnes toutes numériques/booléennes, lignes encodées en numpy ---
+# En-tête / fin du format COPY binaire (envoyés par nous : cp.write ne les ajoute pas)
+_PGCOPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00" + b"\x00\x00\x00\x00" + b"\x00\x00\x00\x00"
+_PGCOPY_TRAILER = b"\xff\xff"
+# OID colonne -> (dtype numpy natif, dtype binaire PostgreSQL big-endian)
+_BINARY_FIXED = {
+    16: (np.bool_, np.dtype("u1")),      # boolean
+    21: (np.int16, np.dtype(">i2")),     # smallint
+    23: (np.int32, np.dtype(">i4")),     # integer
+    20: (np.int64, np.dtype(">i8")),     # bigint
+    700: (np.float32, np.dtype(">f4")),  # real
+    701: (np.float64, np.dtype(">f8")),  # double precision
+}
+
+def _fixed_layout(gdf, cols, oids):
+    """Types binaires de largeur fixe si tous les attributs sont numériques, sinon None."""
+    layout = []
+    for c in cols[:-1]:
+        if oids[c] not in _BINARY_FIXED or not pd.api.types.is_numeric_dtype(gdf[c].dtype):
+            return None
+        layout.append(_BINARY_FIXED[oids[c]])
+    return layout
+
+def _scatter(buf, pos, rows):
+    """buf[pos[i] + k] = rows[i, k] : écrit un champ de largeur fixe pour toutes les lignes."""
+    buf[pos[:, None] + np.arange(rows.shape[1])] = rows
+
+def _encode_binary_rows(arrays, layout, wkbs):
+    """
+    Encode une tuile au format COPY binaire : par ligne, int16 nombre de champs puis, par
+    champ, int32 longueur (-1 = NULL) et valeur big-endian ; la géométrie (EWKB) en dernier.
+    Les préfixes (tout sauf l'EWKB) sont encodés colonne par colonne en numpy, puis
+    entrelacés avec les EWKB par b"".join : rend des blocs d'environ COPY_WRITE_BYTES.
+    """
+    n = len(wkbs)
+    present = [~np.asarray(pd.isna(a)) for a in arrays]
+    geom_ok = np.asarray(pd.notna(wkbs))
+    wkbs = wkbs.copy()
+    wkbs[~geom_ok] = b""  # NULL : longueur -1, aucun octet
+    glen = np.fromiter(map(len, wkbs), dtype=np.int64, count=n)
+
+    plen = np.full(n, 2 + 4 * (len(arrays) + 1), dtype=np.int64)
+    for (_, be), ok in zip(layout, present):
+        plen += be.itemsize * ok
+    starts = np.zeros(n, dtype=np.int64)
+    np.cumsum(plen[:-1], out=starts[1:])
+    buf = np.empty(int(plen.sum()), dtype=np.uint8)
+
+    _scatter(buf, starts, np.full(n, len(arrays) + 1, dtype=">i2").view(np.uint8).reshape(n, 2))
+    pos = starts + 2
+    for (native, be), a, ok in zip(layout, arrays, present):
+        w = be.itemsize
+        _scatter(buf, pos, np.where(ok, w, -1).astype(">i4").view(np.uint8).reshape(n, 4))
+        pos += 4
+        data = a.to_numpy(dtype=native, na_value=0).astype(be).view(np.uint8).reshape(n, w)
+        _scatter(buf, pos[ok], data[ok])
+        pos += w * ok
+    _scatter(buf, pos, np.where(geom_ok, glen, -1).astype(">i4").view(np.uint8).reshape(n, 4))
+
+    prefix = buf.tobytes()
+    heads = [prefix[i:j] for i, j in zip(starts.tolist(), (starts + plen).tolist())]
+    # coupures tous les ~COPY_WRITE_BYTES : mémoire bornée même avec de gros polygones
+    ends = np.cumsum(plen + glen)
+    cuts = np.searchsorted(ends, np.arange(COPY_WRITE_BYTES, ends[-1], COPY_WRITE_BYTES)).tolist()
+    for i, j in zip([0, *cuts], [*cuts, n]):
+        if i < j:
+            yield b"".join(chain.from_iterable(zip(heads[i:j], wkbs[i:j])))
+
+def _iter_tiles(gdf, cols, srid=None, output_dimension=3):
+    """
+    Découpe un GeoDataFrame en tuiles de COPY_TILE lignes : tranches contiguës (vues, sans
+    copie) des tableaux de colonnes et de géométries, sans re-matérialiser de DataFrame.
+    Rend (tranches des attributs, EWKB de la tuile).
+    """
+    geoms = np.asarray(gdf.geometry.values)
+    columns = [gdf[c].array for c in cols[:-1]]
+    for start in range(0, len(gdf), COPY_TILE):
+        s = slice(start, start + COPY_TILE)
+        tile = shapely.set_srid(geoms[s], srid) if srid else geoms[s]
+        # EWKB (SRID embarqué) encodé en un seul appel vectorisé par tuile
+        wkbs = shapely.to_wkb(tile, hex=False, include_srid=bool(srid),
+                              output_dimension=output_dimension)
+        yield [a[s] for a in columns], wkbs
+
+def _copy_frame(cp, gdf, cols, srid=None, output_dimension=3, layout=None):
+    """
+    Écrit les lignes d'un GeoDataFrame dans un COPY binaire ouvert (géométrie en dernier).
+    `layout` (cf. _fixed_layout) : tuiles encodées en numpy, envoyées par blocs bornés ;
+    sinon write_row ligne à ligne (types mixtes : texte, dates...).
+    """
+    for arrays, wkbs in _iter_tiles(gdf, cols, srid, output_dimension):
+        if layout is not None:
+            for chunk in _encode_binary_rows(arrays, layout, wkbs):
+                cp.write(chunk)
+            continue
+        for row in zip(*map(_copy_values, arrays), wkbs):
+            cp.write_row(row)
+
+def _insert_frame(conn, sql, gdf, cols, srid=None, output_dimension=3):
+    """
+    Repli sans COPY : executemany SQLAlchemy par tuile. Les lignes sont assemblées depuis
+    les tableaux de colonnes (un élément par colonne et par ligne), pas via itertuples.
+    """
+    keys = [f"c{j}" for j in range(len(cols) - 1)] + ["g"]
+    for arrays, wkbs in _iter_tiles(gdf, cols, srid, output_dimension):
+        rows = zip(*map(_copy_values, arrays), wkbs)
+        conn.execute(sql, [dict(zip(keys, row)) for row in rows])
+
+def copy_to_postgis(engine, gdf, table, schema="public", if_exists="replace", dtype=None,
+                    batches=(), srid=None, output_dimension=3):
+    """
+    Écrit un GeoDataFrame via COPY ... FROM STDIN (FORMAT BINARY) en un seul aller-retour.
+    La table est créée par un to_postgis à 0 ligne (mêmes types qu'avant), puis les
+    lignes sont streamées avec la géométrie pré-encodée en (E)WKB (vectorisé shapely).
+    `batches` : lots suivants (mêmes colonnes que `gdf`), écrits dans le même COPY
+    au fil de leur production -> mémoire bornée à un lot.
+    `srid` / `output_dimension` : SRID embarqué dans l'EWKB et dimension écrite (2 ou 3).
+    Repli si le driver n'est pas psycopg3 : INSERT executemany par tuile.
+    Création et lignes dans une seule transaction : un échec (encodage, réseau...)
+    laisse l'ancienne table intacte, comme le to_postgis d'origine.
+    """
+    geom_col = gdf.geometry.name
+    cols = [c for c in gdf.columns if c != geom_col] + [geom_col]
+    collist = ", ".join(f'"{c}"' for c in cols)
+
+    with engine.begin() as conn:
+        # structure de la table (colonnes + typmod géométrie), sans aucune ligne ;
+        # connexion déjà en transaction -> to_postgis ne valide pas
+        gdf.iloc[:0].to_postgis(table, conn, schema=schema, if_exists=if_exists,
+                                index=False, dtype=dtype)
+
+        if not is_psycopg3_backend(engine):
+            values = [f":c{j}" for j in range(len(cols) - 1)] + ["ST_GeomFromEWKB(:g)"]
+            sql = text(f'INSERT INTO "{schema}"."{table}" ({collist}) VALUES ({", ".join(values)})')
+            _insert_frame(conn, sql, gdf, cols, srid, output_dimension)
+            for b in batches:
+                _insert_frame(conn, sql, b, cols, srid, output_dimension)
+            return
+
+        # même connexion psycopg3 (table créée visible, validée avec les lignes)
+        with conn.connection.driver_connection.cursor() as cur:
+            cur.execute(
+                "SELECT attname, atttypid FROM pg_attribute "
+                "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped",
+                (f'"{schema}"."{table}"',),
+            )
+            oids = dict(cur.fetchall())
+            layout = _fixed_layout(gdf, cols, oids)
+            with cur.copy(f'COPY "{schema}"."{table}" ({collist}) FROM STDIN WITH (FORMAT BINARY)') as cp:
+                cp.set_types([oids[c] for c in cols[:-1]] + [BYTEA_OID])
+                if layout is not None:
+                    cp.write(_PGCOPY_SIGNATURE)
+                _copy_frame(cp, gdf, cols, srid, output_dimension, layout)
+                for b in batches:
+                    _copy_frame(cp, b, cols, srid, output_dimension, layout)
+                if layout is not None:
+                    cp.write(_PGCOPY_TRAILER)
+
+def execute_script(engine, statements):
+    """
+    Exécute une suite d'instructions SQL sans paramètres dans une seule transaction.
+    psycopg3 : mode pipeline (envoi sans attendre chaque résultat, ~1 aller-retour,
+    erreur levée à la première instruction en échec).
+    Autres drivers : un seul texte multi-instructions.
+    Pas de paramètres liés ni de '%' littéral (le texte part tel quel au driver).
+    """
+    if is_psycopg3_backend(engine):
+        rc = engine.raw_connection()
+        try:
+            conn = rc.driver_connection
+            with conn.pipeline(), conn.cursor() as cur:
+                for sql in statements:
+                    cur.execute(sql)
+            conn.commit()
+        finally:
+            rc.close()
+        return
+
+    with engine.begin() as conn:
+        # no_parameters : cursor.execute(sql) sans paramètres -> protocole simple,
+        # qui accepte plusieurs instructions séparées par ';'
+        conn.execute(text(";\n".join(statements)).execution_options(no_parameters=True))
+
+# --- helper robuste d'ouverture avec encodage ---
+# contenu .cpg -> nom d'encodage GDAL (SHAPE_ENCODING) : GDAL ne recode pas
+# les alias Python ("latin-1") ; ces noms restent valides côté Python
+CPG_ENCODINGS = {
+    "UTF-8": "UTF-8", "UTF8": "UTF-8",
+    "LATIN1": "ISO-8859-1", "ISO-8859-1": "ISO-8859-1",
+    "CP1252": "CP1252", "WINDOWS-1252": "CP1252",
+}
+
+def read_cpg(cpg_path):
+    """Encodage déclaré par le .cpg (None si absent)."""
+    if not os.path.exists(cpg_path):
+        return None
+    with open(cpg_path, errors="ignore") as f:
+        raw = f.read().strip().upper()
+    return CPG_ENCODINGS.get(raw, raw)
+
+@functools.lru_cache(maxsize=4096)
+def detect_encoding(cpg_path):
+    """read_cpg lu une seule fois par chemin (dossier d'ingestion relu par les workers)."""
+    return read_cpg(cpg_path)